@@ -0,0 +1,81 @@
+"""
+Benchmark of critical path priorities on a synthetic mixed campaign.
+
+Every step of the npt flow is replaced by a sleep that lasts as long as its
+stage cost (scaled by the size of the protein), so the benchmark only measures
+how well the tasks are ordered on the workers. A few large proteins are
+submitted last, which is the worst case for the default ordering.
+
+    python benchmarks/bench_scheduling.py
+"""
+import argparse
+import time
+from dask import delayed
+from dask.distributed import wait
+from md_flow.flow import MDCluster
+from md_flow.scheduling import STAGE_COSTS
+
+
+def sleep_step(seconds: float, *upstream) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+def synthetic_npt_flow(protein: int, scale: float, unit: float):
+    """
+    Builds a chain of sleeps with the same step names (and thus the same
+    priorities) as `npt_md_flow`.
+    """
+    step = None
+    for stage, cost in STAGE_COSTS.items():
+        upstream = [] if step is None else [step]
+        step = delayed(sleep_step, pure=True)(
+            scale * cost * unit,
+            *upstream,
+            dask_key_name=f"{stage}-protein{protein}",
+        )
+    return step
+
+
+def run_campaign(scales: list[float], n_workers: int, unit: float, priorities: bool) -> float:
+    cluster = MDCluster(
+        threads_per_worker=1,
+        n_workers=n_workers,
+        critical_path_priorities=priorities,
+    )
+    try:
+        start = time.perf_counter()
+        flows = [
+            synthetic_npt_flow(protein, scale, unit) for protein, scale in enumerate(scales)
+        ]
+        futures = cluster.run_campaign(flows, scales=scales)
+        wait(futures)
+        return time.perf_counter() - start
+    finally:
+        cluster.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--small", type=int, default=12)
+    parser.add_argument("--large", type=int, default=2)
+    parser.add_argument("--large-scale", type=float, default=5.0)
+    parser.add_argument("--unit", type=float, default=0.01, help="seconds per cost unit")
+    args = parser.parse_args()
+
+    scales = [1.0] * args.small + [args.large_scale] * args.large
+    total = sum(scale * sum(STAGE_COSTS.values()) * args.unit for scale in scales)
+    longest = max(scales) * sum(STAGE_COSTS.values()) * args.unit
+    print(f"{len(scales)} proteins on {args.workers} workers")
+    print(f"lower bound on makespan: {max(total / args.workers, longest):.2f} s")
+
+    default = run_campaign(scales, args.workers, args.unit, priorities=False)
+    print(f"default dask ordering:    {default:.2f} s")
+    prioritized = run_campaign(scales, args.workers, args.unit, priorities=True)
+    print(f"critical path priorities: {prioritized:.2f} s")
+    print(f"makespan reduction:       {100 * (1 - prioritized / default):.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import logging
+import math
+import os
+import statistics
+import tempfile
+import threading
+from dataclasses import asdict
+from .models import MDRun, PerformanceRecord, StageEstimate
+from .steps import get_mdp_path, read_mdp_parameters
+
+
+logger = logging.getLogger(__file__)
+
+# mdrun throughput is modelled as scaling linearly with threads and inversely
+# with the number of atoms, i.e. atom * ns / day per thread is ~constant on a
+# given node type. this default (~50 ns/day for 30k atoms on 8 threads) is
+# used until runs on the node type have been recorded.
+DEFAULT_THROUGHPUT = 200_000.0
+REFERENCE_ATOMS = 30_000
+# don't spread fewer atoms than this over a single thread
+ATOMS_PER_THREAD = 5_000
+
+# the mdruns of the npt flow after the structure is prepared. equilibration
+# runs are capped at the default nsteps of `standard_md_run`, production runs
+# the full prod.mdp.
+NPT_STAGES = [
+    ("md_temp_equilibrate", "nvt_eq.mdp", 10_000),
+    ("md_pressure_equilibrate", "npt_eq.mdp", 10_000),
+    ("md_run", "prod.mdp", None),
+]
+
+
+def count_atoms(gro_file: str) -> int:
+    """
+    Helper that reads the number of atoms from the header of a gro file.
+    """
+    with open(gro_file, "r") as gro:
+        gro.readline()
+        return int(gro.readline().strip())
+
+
+def read_ns_per_day(log_file: str) -> float | None:
+    """
+    Helper that reads the ns/day performance reported at the end of an mdrun
+    log, or None if the run didn't finish.
+    """
+    with open(log_file, "r", errors="replace") as log:
+        for line in log:
+            if line.startswith("Performance:"):
+                return float(line.split()[1])
+    return None
+
+
+class PerformanceHistory:
+    """
+    Measured mdrun performance per node type, optionally persisted to a json
+    file so estimates improve across campaigns.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.records: list[PerformanceRecord] = []
+        # runs are recorded from the done callbacks of their futures
+        self.lock = threading.Lock()
+        if path:
+            self.records = self.load()
+
+    def load(self) -> list[PerformanceRecord]:
+        """
+        The records persisted to the history file.
+        """
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, "r") as history:
+            return [PerformanceRecord(**record) for record in json.load(history)]
+
+    def add(self, record: PerformanceRecord):
+        """
+        Add a measurement. With a history file, the records other clusters
+        have written to it since are merged in before it is rewritten.
+        """
+        with self.lock:
+            if not self.path:
+                self.records.append(record)
+                return
+            self.records = [*self.load(), record]
+            # write to a unique temp file first so the history is never
+            # truncated, nor clobbered by another process writing it
+            directory, name = os.path.split(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+            try:
+                with os.fdopen(fd, "w") as history:
+                    json.dump(
+                        [asdict(record) for record in self.records], history, indent=2
+                    )
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def throughput(self, node_type: str) -> float:
+        """
+        The median atom * ns / day per thread measured on the node type.
+        """
+        measured = [
+            record.ns_per_day * record.atoms / record.threads
+            for record in self.records
+            if record.node_type == node_type
+        ]
+        if not measured:
+            return DEFAULT_THROUGHPUT
+        return statistics.median(measured)
+
+
+class CostModel:
+    """
+    Predicts the size and runtime of the mdruns of a flow from the prepared
+    structure, the stage mdp files, and the performance history of the node
+    type the runs are placed on.
+    """
+
+    def __init__(
+        self,
+        history: PerformanceHistory | None = None,
+        node_type: str = "default",
+        max_threads: int = 1,
+    ):
+        self.history = history or PerformanceHistory()
+        self.node_type = node_type
+        self.max_threads = max_threads
+
+    def threads_for(self, atoms: int) -> int:
+        """
+        Number of threads to give an mdrun of the given size: a power of two
+        so that smaller runs tile a worker, capped at the worker size.
+        """
+        wanted = max(1, atoms // ATOMS_PER_THREAD)
+        threads = 2 ** int(math.log2(wanted))
+        return max(1, min(threads, self.max_threads))
+
+    def estimate_stage(
+        self,
+        stage: str,
+        atoms: int,
+        settings: str,
+        nsteps: int | None = None,
+    ) -> StageEstimate:
+        """
+        Estimate the runtime of a single mdrun.
+
+        Parameters:
+            stage (str): name of the step function running the mdrun
+            atoms (int): number of atoms in the simulation box
+            settings (str): the mdp file of the stage
+            nsteps (int): number of steps if the stage overrides the mdp
+        Returns:
+            estimate (StageEstimate): the predicted size and runtime
+        """
+        parameters = read_mdp_parameters(get_mdp_path(settings))
+        threads = self.threads_for(atoms)
+        return StageEstimate(
+            stage=stage,
+            atoms=atoms,
+            threads=threads,
+            nsteps=nsteps or int(parameters["nsteps"]),
+            dt=float(parameters["dt"]),
+            ns_per_day=self.history.throughput(self.node_type) * threads / atoms,
+        )
+
+    def estimate_npt(self, gro_file: str) -> list[StageEstimate]:
+        """
+        Estimate the runtime of every mdrun of the npt flow that follows the
+        preparation of the structure in the gro file.
+        """
+        atoms = count_atoms(gro_file)
+        return [
+            self.estimate_stage(stage, atoms, settings, nsteps)
+            for stage, settings, nsteps in NPT_STAGES
+        ]
+
+    def relative_cost(self, estimates: list[StageEstimate]) -> float:
+        """
+        Runtime of the npt flow estimates relative to the same flow on the
+        reference system, used as the scale of the flow's priorities.
+        """
+        reference = [
+            self.estimate_stage(stage, REFERENCE_ATOMS, settings, nsteps)
+            for stage, settings, nsteps in NPT_STAGES
+        ]
+        total = sum(estimate.hours for estimate in estimates)
+        return total / sum(estimate.hours for estimate in reference)
+
+    def record(self, run: MDRun):
+        """
+        Add the measured performance of a finished mdrun to the history.
+        """
+        if not run.log_file or not os.path.isfile(run.log_file):
+            return
+        ns_per_day = read_ns_per_day(run.log_file)
+        if ns_per_day is None:
+            return
+        record = PerformanceRecord(
+            node_type=self.node_type,
+            atoms=count_atoms(run.gro_file),
+            threads=run.threads or self.max_threads,
+            ns_per_day=ns_per_day,
+        )
+        logger.info(f"recording mdrun performance {record}")
+        self.history.add(record)
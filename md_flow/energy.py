@@ -0,0 +1,313 @@
+import logging
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .models import EnergyTerms, MDRun
+
+
+logger = logging.getLogger(__file__)
+
+ENX_NAMES_MAGIC = -55555
+ENX_FRAME_MAGIC = -7777777
+# xdr_datatype enum of gromacs, mapped to the numpy type of a sub-block
+XDR_DATATYPES = {0: ">i4", 1: ">f4", 2: ">f8", 3: ">i8", 4: ">u4"}
+XDR_DATATYPE_STRING = 5
+
+# columns identifying each run in the energy store
+KEY_COLUMNS = ["protein", "stage", "replica"]
+# columns every stored run has, besides its energy terms
+RUN_SCHEMA = pa.schema(
+    [
+        ("protein", pa.string()),
+        ("replica", pa.int32()),
+        ("time", pa.float64()),
+        ("step", pa.int64()),
+        ("stage", pa.string()),
+    ]
+)
+
+
+class EDRFormatError(Exception):
+    pass
+
+
+class XDRBuffer:
+    """
+    Minimal reader for the big-endian XDR encoding of gromacs binary files.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+        # reals are floats unless gromacs was compiled in double precision
+        self.real = ">f4"
+
+    def at_end(self) -> bool:
+        return self.offset >= len(self.data)
+
+    def array(self, dtype: str, count: int) -> np.ndarray:
+        values = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        self.offset += values.nbytes
+        return values
+
+    def int(self) -> int:
+        return int(self.array(">i4", 1)[0])
+
+    def int64(self) -> int:
+        return int(self.array(">i8", 1)[0])
+
+    def double(self) -> float:
+        return float(self.array(">f8", 1)[0])
+
+    def reals(self, count: int) -> np.ndarray:
+        return self.array(self.real, count)
+
+    def string(self) -> str:
+        length = self.int()
+        value = self.data[self.offset : self.offset + length]
+        # strings are padded to a multiple of 4 bytes
+        self.offset += (length + 3) // 4 * 4
+        return value.decode().rstrip("\x00")
+
+    def detect_precision(self):
+        """
+        Every energy frame starts with a real that is always -2e10, so it
+        tells us whether the file was written in single or double precision.
+        """
+        for dtype in (">f4", ">f8"):
+            value = np.frombuffer(self.data, dtype=dtype, count=1, offset=self.offset)
+            if value[0] < -1e10:
+                self.real = dtype
+                return
+        raise EDRFormatError("unsupported (pre gromacs 4) energy file format")
+
+
+def read_edr(edr_file: str) -> EnergyTerms:
+    """
+    Reads the energy terms of every frame of a gromacs .edr file into numpy
+    arrays, without needing `gmx energy`.
+
+    Parameters:
+        edr_file (str): path to the energy file written by mdrun
+    Returns:
+        energies (EnergyTerms): the term names and units, and the time, step
+            and value of every term in each frame
+    """
+    with open(edr_file, "rb") as edr:
+        xdr = XDRBuffer(edr.read())
+
+    # the header holds the names and units of the energy terms
+    if xdr.int() != ENX_NAMES_MAGIC:
+        raise EDRFormatError(f"{edr_file} is not a (gromacs 4+) energy file")
+    file_version = xdr.int()
+    nre = xdr.int()
+    names, units = [], []
+    for _ in range(nre):
+        names.append(xdr.string())
+        units.append(xdr.string() if file_version >= 2 else "kJ/mol")
+
+    times, steps, frames = [], [], []
+    while not xdr.at_end():
+        xdr.detect_precision()
+        time, step, values = read_edr_frame(xdr, nre)
+        if values is None:
+            continue
+        times.append(time)
+        steps.append(step)
+        frames.append(values)
+
+    return EnergyTerms(
+        names=names,
+        units=units,
+        time=np.array(times, dtype=np.float64),
+        step=np.array(steps, dtype=np.int64),
+        values=np.array(frames, dtype=np.float64).reshape(len(frames), nre),
+    )
+
+
+def read_edr_frame(xdr: XDRBuffer, nre: int) -> tuple[float, int, np.ndarray | None]:
+    """
+    Helper that reads a single energy frame. Frames that only carry extra data
+    blocks (e.g. orientation restraints) have no energies, and None is
+    returned for their values.
+    """
+    xdr.reals(1)
+    if xdr.int() != ENX_FRAME_MAGIC:
+        raise EDRFormatError("energy frame magic number mismatch")
+    file_version = xdr.int()
+    time = xdr.double()
+    step = xdr.int64()
+    nsum = xdr.int()
+    if file_version >= 3:
+        xdr.int64()  # nsteps
+    if file_version >= 5:
+        xdr.double()  # dt
+    frame_nre = xdr.int()
+    xdr.int()  # reserved
+    nblock = xdr.int()
+    if frame_nre not in (0, nre) or nblock < 0:
+        raise EDRFormatError(f"corrupt energy frame at step {step}")
+    if nblock and file_version < 4:
+        raise EDRFormatError("unsupported (pre gromacs 4.6) energy blocks")
+
+    sub_blocks = []
+    for _ in range(nblock):
+        xdr.int()  # block id
+        nsub = xdr.int()
+        sub_blocks += [(xdr.int(), xdr.int()) for _ in range(nsub)]
+    xdr.int()  # e_size
+    xdr.int()  # reserved
+    xdr.int()  # reserved
+
+    # each term has its value, and (when averages are stored) the average and
+    # sum of fluctuations since the last frame
+    values = xdr.reals(frame_nre * (3 if nsum > 0 else 1))[:: 3 if nsum > 0 else 1]
+
+    for datatype, count in sub_blocks:
+        if datatype == XDR_DATATYPE_STRING:
+            for _ in range(count):
+                xdr.int()
+                xdr.string()
+        elif datatype in XDR_DATATYPES:
+            xdr.array(XDR_DATATYPES[datatype], count)
+        else:
+            raise EDRFormatError(f"unknown energy block data type {datatype}")
+
+    return time, step, values if frame_nre else None
+
+
+class EnergyStore:
+    """
+    Campaign-wide columnar store of mdrun energy terms. Every run is written
+    to its own parquet file, partitioned by stage, with one column per energy
+    term and the protein, stage and replica as keys. Queries only read the
+    partitions and columns they need.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def append(self, run: MDRun, protein: str, stage: str, replica: int = 0) -> str:
+        """
+        Add the energy terms of a finished run to the store, replacing any
+        earlier copy of the same run, and return the path of its file.
+        """
+        energies = read_edr(run.energy)
+        columns = {
+            "protein": pa.array([protein] * len(energies.time)),
+            "replica": pa.array([replica] * len(energies.time), type=pa.int32()),
+            "time": pa.array(energies.time),
+            "step": pa.array(energies.step),
+        }
+        for i, name in enumerate(energies.names):
+            columns[name] = pa.array(energies.values[:, i], type=pa.float32())
+        table = pa.table(columns)
+
+        stage_dir = os.path.join(self.root, f"stage={stage}")
+        os.makedirs(stage_dir, exist_ok=True)
+        path = os.path.join(stage_dir, f"{protein}-{replica}.parquet")
+        # write to a hidden file first so queries never see a partial run
+        tmp_path = os.path.join(stage_dir, f".{protein}-{replica}.parquet")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"stored {len(energies.names)} energy terms of {protein} {stage} in {path}")
+        return path
+
+    def dataset(self, stage: str | None = None) -> ds.Dataset:
+        """
+        The arrow dataset of the store, or of a single stage. Stages store
+        different energy terms, so the schemas of the files are unified, and
+        terms a stage doesn't have read as nulls. The dataset is empty if
+        nothing has been stored (for the stage) yet.
+        """
+        path = self.root if stage is None else os.path.join(self.root, f"stage={stage}")
+        if not os.path.isdir(path):
+            return ds.InMemoryDataset(RUN_SCHEMA.empty_table())
+        files = ds.dataset(path, format="parquet").files
+        if not files:
+            return ds.InMemoryDataset(RUN_SCHEMA.empty_table())
+        partitioning = ds.partitioning(pa.schema([("stage", pa.string())]), flavor="hive")
+        options = dict(
+            format="parquet", partitioning=partitioning, partition_base_dir=self.root
+        )
+
+        fragments = ds.dataset(files, **options).get_fragments()
+        schema = pa.unify_schemas(
+            [*(fragment.physical_schema for fragment in fragments), partitioning.schema]
+        )
+        return ds.dataset(files, schema=schema, **options)
+
+    def read(
+        self,
+        terms: list[str],
+        stage: str | None = None,
+        proteins: list[str] | None = None,
+    ) -> pa.Table:
+        """
+        Read the given energy terms (along with the run keys and time) of
+        every stored run, optionally restricted to a stage and proteins.
+        Terms that no stored run has read as nulls.
+        """
+        dataset = self.dataset(stage)
+        condition = None
+        if proteins is not None:
+            condition = pc.field("protein").isin(proteins)
+        columns = [*KEY_COLUMNS, "time", *terms]
+        table = dataset.to_table(
+            columns=[column for column in columns if column in dataset.schema.names],
+            filter=condition,
+        )
+        for term in terms:
+            if term not in table.column_names:
+                table = table.append_column(
+                    pa.field(term, pa.float32()), pa.nulls(table.num_rows, pa.float32())
+                )
+        return table.select(columns)
+
+    def summary(self, term: str, stage: str | None = None) -> pa.Table:
+        """
+        Summarize an energy term per run: its mean, standard deviation and
+        drift (slope of a linear fit over time, per ps). For example,
+        `summary("Density", stage="npt_eq")` finds the NPT runs whose density
+        drifted.
+        """
+        table = self.read([term], stage=stage)
+        table = table.filter(pc.is_valid(table[term]))
+        time = table["time"]
+        value = pc.cast(table[term], pa.float64())
+        table = table.append_column("t_y", pc.multiply(time, value))
+        table = table.append_column("t_t", pc.multiply(time, time))
+        grouped = table.group_by(KEY_COLUMNS).aggregate(
+            [
+                (term, "mean"),
+                (term, "stddev"),
+                (term, "count"),
+                (term, "sum"),
+                ("time", "sum"),
+                ("t_y", "sum"),
+                ("t_t", "sum"),
+            ]
+        )
+
+        # least squares slope from the sums of each run
+        n = grouped[f"{term}_count"]
+        sum_t = grouped["time_sum"]
+        numerator = pc.subtract(
+            pc.multiply(n, grouped["t_y_sum"]),
+            pc.multiply(sum_t, grouped[f"{term}_sum"]),
+        )
+        denominator = pc.subtract(
+            pc.multiply(n, grouped["t_t_sum"]), pc.multiply(sum_t, sum_t)
+        )
+        drift = pc.divide(numerator, denominator)
+        return pa.table(
+            {
+                **{key: grouped[key] for key in KEY_COLUMNS},
+                f"{term}_mean": grouped[f"{term}_mean"],
+                f"{term}_stddev": grouped[f"{term}_stddev"],
+                f"{term}_drift": drift,
+            }
+        )
@@ -1,7 +1,13 @@
+import contextlib
+import dask
 import logging
-from dask.distributed import Client
+import os
+from functools import partial
+from concurrent.futures import Future as Handle
+from dask.distributed import Client, Future
 from dask.delayed import Delayed
 from dataclasses import dataclass
+from md_flow.cost import CostModel, PerformanceHistory
 from md_flow.steps import (
     get_alphafold_pdb,
     pdb2gmx,
@@ -10,48 +16,329 @@ from md_flow.steps import (
     md_temp_equilibrate,
     md_pressure_equilibrate,
     md_run,
+    store_energies,
+    collect_run,
 )
-from md_flow.models import MDRun
+from md_flow.models import MDRun, ProteinInput, StageEstimate, WatchdogSettings
+from md_flow.scheduling import prioritize
 
 
 logger = logging.getLogger(__file__)
 
+# worker resource that mdruns reserve one unit of per thread
+MDRUN_RESOURCE = "cores"
+
 
 @dataclass
 class MDCluster:
     threads_per_worker: int
     n_workers: int
+    critical_path_priorities: bool = True
+    node_type: str = "default"
+    performance_history: str | None = None
+    energy_store: str | None = None
+    work_dir: str | None = None
 
     def __post_init__(self):
         self.client = Client(
-            threads_per_worker=self.threads_per_worker, n_workers=self.n_workers
+            threads_per_worker=self.threads_per_worker,
+            n_workers=self.n_workers,
+            resources={MDRUN_RESOURCE: self.threads_per_worker},
+        )
+        self.cost_model = CostModel(
+            PerformanceHistory(self.performance_history),
+            node_type=self.node_type,
+            max_threads=self.threads_per_worker,
+        )
+        self.estimates: dict[str, list[StageEstimate]] = {}
+        # hydrated structures, shared by estimates and campaigns
+        self.structures: dict[str, Future] = {}
+
+    def optimize_structure(self, uniprot_id: str, scale: float = 1.0) -> MDRun:
+        """
+        Run the optimize structure flow. The size of the system isn't known
+        up front, so its mdrun reserves a whole worker.
+        """
+        flow = structure_opt_flow(
+            uniprot_id,
+            work_dir=self.flow_dir(uniprot_id),
+            threads=self.threads_per_worker,
         )
+        return self.run_flow(flow, scale=scale)
+
+    def npt(
+        self,
+        uniprot_id: str,
+        watchdog: WatchdogSettings | None = None,
+        scale: float = 1.0,
+        replica: int = 0,
+    ) -> MDRun:
+        """
+        Run the npt flow for a single protein. Like `optimize_structure`, its
+        mdruns reserve a whole worker; use `npt_campaign` to size them.
+        """
+        flow = npt_md_flow(
+            uniprot_id,
+            watchdog=watchdog,
+            energy_store=self.energy_store,
+            replica=replica,
+            work_dir=self.flow_dir(uniprot_id, replica),
+            threads=self.threads_per_worker,
+        )
+        return self.run_flow(flow, scale=scale)
+
+    def npt_campaign(
+        self,
+        uniprot_ids: list[str],
+        watchdog: WatchdogSettings | None = None,
+        replica: int = 0,
+    ) -> list[Handle]:
+        """
+        Run the npt flow for a batch of proteins without blocking. The
+        structures are prepared first (see `prepare`). As soon as a protein's
+        structure is hydrated, the cost of its mdruns is estimated (see
+        `self.estimates`) and they are submitted, each reserving only the
+        threads its system size warrants. Their priorities grow with the
+        estimated cost, so of the mdruns waiting for cores the scheduler
+        starts the largest first, and smaller runs fill the gaps.
+
+        Returns a `concurrent.futures.Future` per protein, which resolves to
+        the MDRun of its production run.
+        """
+        handles = []
+        for uniprot_id, structure in zip(uniprot_ids, self.prepare(uniprot_ids)):
+            handle = Handle()
+            structure.add_done_callback(
+                partial(self._submit_prepared, uniprot_id, handle, watchdog, replica)
+            )
+            handles.append(handle)
+        return handles
 
-    def optimize_structure(self, uniprot_id: str) -> MDRun:
+    def npt_from_structure(
+        self,
+        uniprot_id: str,
+        structure: ProteinInput | Future,
+        watchdog: WatchdogSettings | None = None,
+        replica: int = 0,
+    ) -> Future:
         """
-        Run the optimize structure flow.
+        Run the mdruns of the npt flow (minimization, equilibration and
+        production) for an already hydrated structure, sized by the cost
+        model. The measured performance of the production run is added to
+        the performance history once it finishes.
         """
-        return self.client.compute(structure_opt_flow(uniprot_id))
+        flow, scale = self._sized_npt_flow(uniprot_id, structure, watchdog, replica)
+        run = self.run_flow(flow, scale=scale)
+        run.add_done_callback(self._record_performance)
+        return run
 
-    def npt(self, uniprot_id: str) -> MDRun:
-        return self.client.compute(npt_md_flow(uniprot_id))
+    def prepare(self, uniprot_ids: list[str]) -> list[Future]:
+        """
+        Fetch, solvate and neutralize the structures of a batch of proteins.
+        The futures are kept, so estimating and running a campaign prepare
+        each protein only once.
+        """
+        missing = [
+            uniprot_id
+            for uniprot_id in dict.fromkeys(uniprot_ids)
+            if uniprot_id not in self.structures
+            or self.structures[uniprot_id].status in ("error", "cancelled")
+        ]
+        if missing:
+            flows = [
+                hydration_flow(uniprot_id, work_dir=self.flow_dir(uniprot_id))
+                for uniprot_id in missing
+            ]
+            self.structures.update(zip(missing, self.run_campaign(flows)))
+        return [self.structures[uniprot_id] for uniprot_id in uniprot_ids]
 
-    def run_flow(self, flow: Delayed) -> MDRun:
+    def estimate(self, uniprot_ids: list[str]) -> dict[str, list[StageEstimate]]:
         """
-        Run a custom molecular dynamics flow
+        Estimate the size and runtime of the npt mdruns of a batch of
+        proteins, e.g. for capacity planning. Only the hydrated structures are
+        needed, and a later `npt_campaign` reuses them.
         """
-        return self.client.compute(flow)
+        structures = self.prepare(uniprot_ids)
+        return {
+            uniprot_id: self._estimate(uniprot_id, structure)
+            for uniprot_id, structure in zip(uniprot_ids, self.client.gather(structures))
+        }
 
+    def run_flow(self, flow: Delayed, scale: float = 1.0) -> MDRun:
+        """
+        Run a custom molecular dynamics flow. Steps write fixed file names, so
+        flows that run at the same time need their own `work_dir` (see
+        `flow_dir`).
+        """
+        return self.run_campaign([flow], scales=[scale])[0]
 
-def structure_opt_flow(uniprot_id: str) -> Delayed:
-    protein_id = get_alphafold_pdb(uniprot_id)
-    protein = pdb2gmx(protein_id)
-    hydrated_protein = hydrate_simulation_box(protein)
-    return optimize_configuration(hydrated_protein)
+    def run_campaign(
+        self, flows: list[Delayed], scales: list[float] | None = None
+    ) -> list[MDRun]:
+        """
+        Run a batch of custom flows. They are submitted together so the
+        scheduler can order the whole campaign by critical path before any
+        task starts.
+        """
+        if self.critical_path_priorities:
+            scales = scales or [1.0] * len(flows)
+            flows = [prioritize(flow, scale=scale) for flow, scale in zip(flows, scales)]
+        return self.client.compute(flows)
 
+    def flow_dir(self, uniprot_id: str, replica: int | None = None) -> str:
+        """
+        The working directory of a protein's flow (or of one of its replicas),
+        under the cluster's `work_dir`, so concurrent flows don't overwrite
+        each other's files.
+        """
+        path = os.path.join(self.work_dir or os.getcwd(), uniprot_id)
+        if replica is not None:
+            path = os.path.join(path, f"replica_{replica}")
+        return path
 
-def npt_md_flow(uniprot_id: str) -> Delayed:
-    opt_struct = structure_opt_flow(uniprot_id)
-    t_equil = md_temp_equilibrate(opt_struct)
-    p_equil = md_pressure_equilibrate(t_equil)
-    return md_run(p_equil)
+    def _estimate(self, uniprot_id: str, structure: ProteinInput) -> list[StageEstimate]:
+        # the hydrated box has as many atoms as the minimized one
+        estimates = self.cost_model.estimate_npt(structure.gro_file)
+        self.estimates[uniprot_id] = estimates
+        logger.info(f"estimated mdruns for {uniprot_id} = {estimates}")
+        return estimates
+
+    def _sized_npt_flow(
+        self,
+        uniprot_id: str,
+        structure: ProteinInput | Future,
+        watchdog: WatchdogSettings | None,
+        replica: int,
+    ) -> tuple[Delayed, float]:
+        if isinstance(structure, Future):
+            structure = structure.result()
+        estimates = self._estimate(uniprot_id, structure)
+        threads = estimates[0].threads
+        work_dir = self.flow_dir(uniprot_id, replica)
+
+        with mdrun_resources(threads):
+            opt_struct = optimize_configuration(
+                structure, threads=threads, work_dir=work_dir
+            )
+        flow = equilibrate_and_run_flow(
+            opt_struct,
+            watchdog=watchdog,
+            threads=threads,
+            energy_store=self.energy_store,
+            protein=uniprot_id,
+            replica=replica,
+            work_dir=work_dir,
+        )
+        return flow, self.cost_model.relative_cost(estimates)
+
+    def _submit_prepared(
+        self,
+        uniprot_id: str,
+        handle: Handle,
+        watchdog: WatchdogSettings | None,
+        replica: int,
+        structure: Future,
+    ):
+        # called back once the structure is hydrated
+        try:
+            flow, scale = self._sized_npt_flow(uniprot_id, structure, watchdog, replica)
+            run = self.run_flow(flow, scale=scale)
+        except Exception as e:
+            handle.set_exception(e)
+            return
+        run.add_done_callback(partial(self._finish, handle))
+
+    def _finish(self, handle: Handle, future: Future):
+        try:
+            run = future.result()
+        except Exception as e:
+            handle.set_exception(e)
+            return
+        handle.set_result(run)
+        self._record_performance(future)
+
+    def _record_performance(self, future: Future):
+        if future.status == "finished":
+            self.cost_model.record(future.result())
+
+
+def mdrun_resources(threads: int | None = None) -> contextlib.AbstractContextManager:
+    """
+    Context in which the mdrun steps built reserve as many of a worker's
+    cores as they run threads. Other steps (e.g. storing energies) should be
+    built outside of it, so they don't wait for free cores.
+    """
+    if threads is None:
+        return contextlib.nullcontext()
+    return dask.annotate(resources={MDRUN_RESOURCE: threads})
+
+
+def hydration_flow(uniprot_id: str, work_dir: str | None = None) -> Delayed:
+    protein_id = get_alphafold_pdb(uniprot_id, work_dir=work_dir)
+    protein = pdb2gmx(protein_id, work_dir=work_dir)
+    return hydrate_simulation_box(protein, work_dir=work_dir)
+
+
+def structure_opt_flow(
+    uniprot_id: str, work_dir: str | None = None, threads: int | None = None
+) -> Delayed:
+    hydrated_protein = hydration_flow(uniprot_id, work_dir=work_dir)
+    with mdrun_resources(threads):
+        return optimize_configuration(
+            hydrated_protein, threads=threads, work_dir=work_dir
+        )
+
+
+def npt_md_flow(
+    uniprot_id: str,
+    watchdog: WatchdogSettings | None = None,
+    energy_store: str | None = None,
+    replica: int = 0,
+    work_dir: str | None = None,
+    threads: int | None = None,
+) -> Delayed:
+    opt_struct = structure_opt_flow(uniprot_id, work_dir=work_dir, threads=threads)
+    return equilibrate_and_run_flow(
+        opt_struct,
+        watchdog=watchdog,
+        threads=threads,
+        energy_store=energy_store,
+        protein=uniprot_id,
+        replica=replica,
+        work_dir=work_dir,
+    )
+
+
+def equilibrate_and_run_flow(
+    opt_struct: MDRun | Delayed | Future,
+    watchdog: WatchdogSettings | None = None,
+    threads: int | None = None,
+    energy_store: str | None = None,
+    protein: str | None = None,
+    replica: int = 0,
+    work_dir: str | None = None,
+) -> Delayed:
+    # energies are stored in side branches, so the next stage only depends
+    # on the mdrun before it
+    stored = []
+
+    def store(run: Delayed, stage: str):
+        if energy_store is not None:
+            stored.append(store_energies(run, energy_store, protein, stage, replica))
+
+    with mdrun_resources(threads):
+        t_equil = md_temp_equilibrate(
+            opt_struct, watchdog=watchdog, threads=threads, work_dir=work_dir
+        )
+    store(t_equil, "nvt_eq")
+    with mdrun_resources(threads):
+        p_equil = md_pressure_equilibrate(
+            t_equil, watchdog=watchdog, threads=threads, work_dir=work_dir
+        )
+    store(p_equil, "npt_eq")
+    with mdrun_resources(threads):
+        prod = md_run(p_equil, threads=threads, work_dir=work_dir)
+    store(prod, "prod")
+    if not stored:
+        return prod
+    return collect_run(prod, *stored)
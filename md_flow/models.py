@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 import logging
 
@@ -71,6 +71,89 @@ class NPTEquilibrationInput:
     settings_file: str | None = "npt_eq.mdp"
 
 
+@dataclass
+class Fallback:
+    """
+    Safer settings applied when retrying an mdrun that was aborted by the
+    instability watchdog. `parameters` are mdp overrides (e.g. a smaller dt),
+    and `minimize` runs an extra steepest descent step before the retry (which
+    then regenerates velocities at the reference temperature). Unless `nsteps` is overridden too, the number of steps is scaled with dt
+    so the retry simulates the same amount of time.
+    """
+
+    name: str
+    parameters: dict[str, Any] = field(default_factory=dict)
+    minimize: bool = False
+
+
+def default_fallbacks() -> list[Fallback]:
+    return [
+        Fallback(name="half_dt", parameters={"dt": 0.001}),
+        Fallback(name="minimize_half_dt", parameters={"dt": 0.001}, minimize=True),
+    ]
+
+
+@dataclass
+class WatchdogSettings:
+    poll_interval: float = 2.0
+    max_constraint_warnings: int = 5
+    max_temperature: float = 600.0
+    max_potential_energy: float = 0.0
+    fallbacks: list[Fallback] = field(default_factory=default_fallbacks)
+
+
+@dataclass
+class Incident:
+    stage: str
+    attempt: int
+    reason: str
+    step: int | None = None
+    fallback: str | None = None
+
+
+@dataclass
+class PerformanceRecord:
+    node_type: str
+    atoms: int
+    threads: int
+    ns_per_day: float
+
+
+@dataclass
+class StageEstimate:
+    stage: str
+    atoms: int
+    threads: int
+    nsteps: int
+    dt: float
+    ns_per_day: float
+
+    @property
+    def simulated_ns(self) -> float:
+        # dt is in ps
+        return self.nsteps * self.dt / 1000
+
+    @property
+    def hours(self) -> float:
+        return 24 * self.simulated_ns / self.ns_per_day
+
+
+@dataclass
+class EnergyTerms:
+    """
+    The energy terms of an mdrun, one row per energy frame.
+    """
+
+    names: list[str]
+    units: list[str]
+    time: Any
+    step: Any
+    values: Any
+
+    def __getitem__(self, name: str) -> Any:
+        return self.values[:, self.names.index(name)]
+
+
 @dataclass
 class MDRun:
     md_input: MDRunInput
@@ -78,3 +161,6 @@ class MDRun:
     md_object: Any
     energy: str
     trajectory: str
+    log_file: str | None = None
+    threads: int | None = None
+    incidents: list[Incident] = field(default_factory=list)
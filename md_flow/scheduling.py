@@ -0,0 +1,129 @@
+import logging
+from typing import Any, Hashable
+from dask.core import get_deps
+from dask.delayed import Delayed
+from dask.highlevelgraph import HighLevelGraph, MaterializedLayer
+from dask.utils import key_split
+
+
+logger = logging.getLogger(__file__)
+
+# rough cost of each step for a small (~30k atom) solvated protein, in
+# minutes. only the relative sizes matter for the priorities.
+STAGE_COSTS = {
+    "get_alphafold_pdb": 0.1,
+    "pdb2gmx": 0.1,
+    "hydrate_simulation_box": 0.5,
+    "optimize_configuration": 1.0,
+    "md_temp_equilibrate": 2.0,
+    "md_pressure_equilibrate": 2.0,
+    "md_run": 100.0,
+}
+
+# added on top of the critical path length, so the cheap steps that unblock
+# more mdruns are picked up before long production runs of other proteins
+STAGE_BOOSTS = {
+    "get_alphafold_pdb": 1000.0,
+    "pdb2gmx": 1000.0,
+    "hydrate_simulation_box": 1000.0,
+    "optimize_configuration": 1000.0,
+    "md_temp_equilibrate": 500.0,
+    "md_pressure_equilibrate": 500.0,
+}
+
+
+def stage_name(key: Hashable) -> str:
+    """
+    Helper that finds the name of the step function that produces a task.
+    """
+    return key_split(key).split("-")[0]
+
+
+def critical_path_lengths(
+    dsk: dict[Hashable, Any], costs: dict[Hashable, float]
+) -> dict[Hashable, float]:
+    """
+    Computes the estimated remaining critical path for each task in a graph,
+    i.e. the cost of the task plus the most expensive chain of tasks that
+    depend on it.
+
+    Parameters:
+        dsk (dict): the dask graph of the flow
+        costs (dict): estimated cost of each task in the graph
+    Returns:
+        lengths (dict): remaining critical path length of each task
+    """
+    dependencies, dependents = get_deps(dsk)
+    lengths = {}
+
+    # walk the graph from the final tasks back to the first ones
+    ready = [key for key, deps in dependents.items() if not deps]
+    waiting = {key: len(deps) for key, deps in dependents.items()}
+    while ready:
+        key = ready.pop()
+        downstream = [lengths[dep] for dep in dependents[key]]
+        lengths[key] = costs.get(key, 0.0) + max(downstream, default=0.0)
+        # futures the flow depends on are not part of its graph
+        for dep in dependencies[key] & waiting.keys():
+            waiting[dep] -= 1
+            if waiting[dep] == 0:
+                ready.append(dep)
+    return lengths
+
+
+def task_priorities(
+    dsk: dict[Hashable, Any],
+    scale: float = 1.0,
+    stage_costs: dict[str, float] | None = None,
+    stage_boosts: dict[str, float] | None = None,
+) -> dict[Hashable, float]:
+    """
+    Assigns a dask priority to every task of a flow from the stage the task
+    runs and the estimated critical path that remains after it starts.
+
+    Parameters:
+        dsk (dict): the dask graph of the flow
+        scale (float): how expensive this system is relative to the
+            reference system of the stage costs (e.g. its relative size)
+        stage_costs (dict): estimated cost of each stage, keyed by the name
+            of the step function
+        stage_boosts (dict): priority added to each stage, keyed by the name
+            of the step function
+    Returns:
+        priorities (dict): the priority of each task; higher runs first
+    """
+    stage_costs = STAGE_COSTS if stage_costs is None else stage_costs
+    stage_boosts = STAGE_BOOSTS if stage_boosts is None else stage_boosts
+
+    costs = {key: scale * stage_costs.get(stage_name(key), 0.0) for key in dsk}
+    lengths = critical_path_lengths(dsk, costs)
+    return {
+        key: lengths[key] + stage_boosts.get(stage_name(key), 0.0) for key in dsk
+    }
+
+
+def prioritize(
+    flow: Delayed,
+    scale: float = 1.0,
+    stage_costs: dict[str, float] | None = None,
+    stage_boosts: dict[str, float] | None = None,
+) -> Delayed:
+    """
+    Returns a copy of the flow whose tasks are annotated with critical path
+    priorities (see `task_priorities`). The distributed scheduler compares
+    these across every flow submitted to it, so a campaign of flows is
+    ordered as a whole. Other annotations of the flow are kept.
+    """
+    graph = flow.__dask_graph__()
+    priorities = task_priorities(dict(graph), scale, stage_costs, stage_boosts)
+    logger.info(f"assigned priorities = {priorities}")
+
+    layers = {
+        name: MaterializedLayer(
+            dict(layer),
+            annotations={**(layer.annotations or {}), "priority": priorities.__getitem__},
+        )
+        for name, layer in graph.layers.items()
+    }
+    graph = HighLevelGraph(layers, graph.dependencies)
+    return Delayed(flow.key, graph, layer=flow.__dask_layers__()[0])
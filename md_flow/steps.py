@@ -1,24 +1,38 @@
 import requests
 import logging
 import os
+import uuid
 import gmxapi
 from md_flow import md_inputs
 from typing import Any
 from dask import delayed
-from .models import MDRunInput, MDRun, ProteinInput
+from .models import (
+    Fallback,
+    MDRunInput,
+    MDRun,
+    ProteinInput,
+    WatchdogSettings,
+)
+from .energy import EnergyStore
+from .watchdog import MDInstabilityError, run_watched_mdrun
 
 
 logger = logging.getLogger(__file__)
 
+# seconds to wait on the alphafold database before giving up on a structure
+ALPHAFOLD_TIMEOUT = 60
+
 
 @delayed
-def get_alphafold_pdb(uniprot_id: str) -> str:
+def get_alphafold_pdb(uniprot_id: str, work_dir: str | None = None) -> str:
     """
     Helper function that takes a uniprot ID and returns a path to a PDB file.
 
     Parameters:
         uniprot_id (str): A string representing a unique ID of a protein
             existingin the uniprot database
+        work_dir (str): directory to write the PDB file to (defaults to the
+            current directory)
 
     Returns:
         pdb_string (str): the string (stored in RAM) to the PDB file
@@ -28,7 +42,7 @@ def get_alphafold_pdb(uniprot_id: str) -> str:
     url = "https://alphafold.ebi.ac.uk/api"
     route = f"/prediction/{uniprot_id}"
 
-    response = requests.get(url + route)
+    response = requests.get(url + route, timeout=ALPHAFOLD_TIMEOUT)
     response_info = response.json()
     logger.info(f"response json from alphafold = {response_info}")
     # TODO: make this a unique exception with a better error message
@@ -43,10 +57,10 @@ def get_alphafold_pdb(uniprot_id: str) -> str:
     # TODO: make this a unique exception with a better error message
     if not pdb_url:
         raise Exception
-    pdb_response = requests.get(pdb_url)
+    pdb_response = requests.get(pdb_url, timeout=ALPHAFOLD_TIMEOUT)
 
-    # get the pwd to prepend to relative file paths to be made
-    cwd = os.getcwd()
+    # get the working dir to prepend to relative file paths to be made
+    cwd = get_work_dir(work_dir)
 
     # create the temp pdb file from the string input
     temp_pdb = open(os.path.join(cwd, "temp_input.pdb"), "w")
@@ -62,6 +76,7 @@ def pdb2gmx(
     gro_name="conf",
     top_name="topol",
     itp_name="posre",
+    work_dir: str | None = None,
 ) -> ProteinInput:
     """
     Function that invokes the pdb2gmx helper function in Gromacs. This will
@@ -73,12 +88,14 @@ def pdb2gmx(
         gro_name (str): the name of the .gro file that will be created
         top_name (str): the name of the topology file to be created
         itp_name (str): the name of the .itp file to be created
+        work_dir (str): directory to write the files to (defaults to the
+            current directory)
     Returns:
         OutputDataProxy: output object of gmx cli api from python.
     """
 
-    # get the pwd to prepend to relative file paths to be made
-    cwd = os.getcwd()
+    # get the working dir to prepend to relative file paths to be made
+    cwd = get_work_dir(work_dir)
 
     # build the gro file name, itp, and top file name
     if len(gro_name) < 4 or gro_name[-4:] != ".gro":
@@ -111,7 +128,9 @@ def pdb2gmx(
 # NOTE: since the gromacs output structs are heavily mixed with C++ types,
 #       there's no way to provide effective type annotations here :(
 @delayed
-def hydrate_simulation_box(protein_gro: ProteinInput) -> ProteinInput:
+def hydrate_simulation_box(
+    protein_gro: ProteinInput, work_dir: str | None = None
+) -> ProteinInput:
     """
     Goal of this step is to hydrate the simulation box with an appropriate
     amount of water molecules. A concentration may be provided to ensure the
@@ -119,11 +138,13 @@ def hydrate_simulation_box(protein_gro: ProteinInput) -> ProteinInput:
 
     Parameters:
         protein_gro (Any): The output data structure representing the protein.
+        work_dir (str): directory to write the files to (defaults to the
+            current directory)
     Returns:
         solvated_gro (Any): The solvated output data structure of the protein.
     """
-    # get pwd to prepend to filepaths below
-    cwd = os.getcwd()
+    # get the working dir to prepend to filepaths below
+    cwd = get_work_dir(work_dir)
 
     # increase the size of the protein bounding box and center it
     edit_args = ["editconf", "-c", "-d", "1.5"]
@@ -185,7 +206,11 @@ def hydrate_simulation_box(protein_gro: ProteinInput) -> ProteinInput:
 
 
 @delayed
-def optimize_configuration(solv_output: ProteinInput) -> MDRun:
+def optimize_configuration(
+    solv_output: ProteinInput,
+    threads: int | None = None,
+    work_dir: str | None = None,
+) -> MDRun:
     """
     This step performs a steepest descent optimization to the local minimum of
     the molecular potential. The goal is to remove Any anomalously large forces
@@ -194,60 +219,100 @@ def optimize_configuration(solv_output: ProteinInput) -> MDRun:
 
     # start by getting the tpr file using grompp
     # need to find the nvt equilibration mdp file first
+    cwd = get_work_dir(work_dir)
     mdp_file = get_mdp_path("steep.mdp")
-    tpr_file = md_grompp(mdp_file=mdp_file, input=solv_output, tpr_file_name="em.tpr")
+    tpr_file = md_grompp(
+        mdp_file=mdp_file,
+        input=solv_output,
+        tpr_file_name=os.path.join(cwd, "em.tpr"),
+    )
 
     # read the tpr file into an input
-    return standard_md_run(tpr_file, file_prefix="em")
+    return standard_md_run(tpr_file, file_prefix="em", threads=threads, work_dir=cwd)
 
 
 @delayed
-def md_temp_equilibrate(input: MDRun | MDRunInput, settings="nvt_eq.mdp") -> MDRun:
+def md_temp_equilibrate(
+    input: MDRun | MDRunInput,
+    settings="nvt_eq.mdp",
+    watchdog: WatchdogSettings | None = None,
+    threads: int | None = None,
+    work_dir: str | None = None,
+) -> MDRun:
     """
     Equilibrate the recently minimized configuration with a short NVT MD
-    simulation.
+    simulation. If watchdog settings are given, the run is aborted as soon as
+    it becomes unstable and retried with the configured fallbacks.
     """
 
     # start by getting the tpr file using grompp
     # need to find the nvt equilibration mdp file first
+    cwd = get_work_dir(work_dir)
     mdp_file = get_mdp_path(settings)
     tpr_name = "nvt_eq.tpr"
     tpr_file = md_grompp(
         input=input,
         mdp_file=mdp_file,
-        tpr_file_name=tpr_name,
+        tpr_file_name=os.path.join(cwd, tpr_name),
         posres=True,
     )
 
     # read the tpr file into an input
-    return standard_md_run(tpr_file, file_prefix=tpr_name.split(".")[0])
+    return standard_md_run(
+        tpr_file,
+        file_prefix=tpr_name.split(".")[0],
+        watchdog=watchdog,
+        threads=threads,
+        work_dir=cwd,
+    )
 
 
 @delayed
-def md_pressure_equilibrate(input: MDRun | MDRunInput, settings="npt_eq.mdp") -> MDRun:
+def md_pressure_equilibrate(
+    input: MDRun | MDRunInput,
+    settings="npt_eq.mdp",
+    watchdog: WatchdogSettings | None = None,
+    threads: int | None = None,
+    work_dir: str | None = None,
+) -> MDRun:
     # def md_pressure_equilibrate(nvt_conf: str, top_file: str) -> MDRun:
     # def md_pressure_equilibrate(nvt_conf: str, top_file: str) -> tuple[Any, str, str]:
     """
     Equilibrate the recently temperature equilibrated configuration with a
-    short NPT MD simulation.
+    short NPT MD simulation. If watchdog settings are given, the run is
+    aborted as soon as it becomes unstable and retried with the configured
+    fallbacks.
     """
     # start by getting the tpr file using grompp
     # need to find the nvt equilibration mdp file first
+    cwd = get_work_dir(work_dir)
     mdp_file = get_mdp_path(settings)
     tpr_name = "npt_eq.tpr"
     tpr_file = md_grompp(
         input=input,
         mdp_file=mdp_file,
-        tpr_file_name=tpr_name,
+        tpr_file_name=os.path.join(cwd, tpr_name),
         posres=True,
     )
 
     # read the tpr file into an input
-    return standard_md_run(tpr_file, file_prefix=tpr_name.split(".")[0])
+    return standard_md_run(
+        tpr_file,
+        file_prefix=tpr_name.split(".")[0],
+        watchdog=watchdog,
+        threads=threads,
+        work_dir=cwd,
+    )
 
 
 @delayed
-def md_run(input: MDRun, settings="prod.mdp", nsteps: int | None = None) -> MDRun:
+def md_run(
+    input: MDRun,
+    settings="prod.mdp",
+    nsteps: int | None = None,
+    threads: int | None = None,
+    work_dir: str | None = None,
+) -> MDRun:
     # def md_run(npt_conf: str, top_file: str, nsteps: int | None = None) -> tuple[Any, str, str]:
     """
     Function that runs a molecular dynamics simulation for a given set of input
@@ -255,15 +320,49 @@ def md_run(input: MDRun, settings="prod.mdp", nsteps: int | None = None) -> MDRu
     """
     # start by getting the tpr file using grompp
     # need to find the nvt equilibration mdp file first
+    cwd = get_work_dir(work_dir)
     mdp_file = get_mdp_path(settings)
     tpr_name = settings.split(".")[0] + ".tpr"
     tpr_file = md_grompp(
-        input=input, mdp_file=mdp_file, tpr_file_name=tpr_name, posres=False
+        input=input,
+        mdp_file=mdp_file,
+        tpr_file_name=os.path.join(cwd, tpr_name),
+        posres=False,
     )
     logger.info("editted params; ready to run MD simulation...")
 
     # read the tpr file into an input
-    return standard_md_run(tpr_file, file_prefix="prod", nsteps=nsteps)
+    return standard_md_run(
+        tpr_file, file_prefix="prod", nsteps=nsteps, threads=threads, work_dir=cwd
+    )
+
+
+@delayed
+def store_energies(
+    run: MDRun, store: str, protein: str, stage: str, replica: int = 0
+) -> str | None:
+    """
+    Appends the energy terms of a finished run to the campaign-wide energy
+    store at the given path, and returns the path of the stored file. The
+    store is only an analytics copy, so a failure to write it is logged
+    rather than failing the flow, and None is returned.
+    """
+    try:
+        return EnergyStore(store).append(
+            run, protein=protein, stage=stage, replica=replica
+        )
+    except Exception:
+        logger.exception(f"could not store the {stage} energies of {protein}")
+        return None
+
+
+@delayed
+def collect_run(run: MDRun, *side_outputs: Any) -> MDRun:
+    """
+    Waits for the side branches of a flow (e.g. storing energies) to finish,
+    and passes the run on.
+    """
+    return run
 
 
 # -------------------------------------------------------------------
@@ -274,10 +373,12 @@ def md_grompp(
     mdp_file: str,
     tpr_file_name: str = "topol.tpr",
     posres: bool = False,
+    reference: str | None = None,
 ) -> MDRunInput:
     """
     Helper function that runs gmx grompp in a basic way on the standard
-    set of inputs, and returns the tpr output
+    set of inputs, and returns the tpr output. Position restraints are
+    relative to the input configuration, unless a reference gro is given.
     """
     if isinstance(input, MDRun):
         top = input.md_input.top_file
@@ -289,7 +390,7 @@ def md_grompp(
         raise Exception("Unknown input type.")
     grompp_input_files = {"-f": mdp_file, "-c": input.gro_file, "-p": top}
     if posres:
-        grompp_input_files["-r"] = input.gro_file
+        grompp_input_files["-r"] = reference or input.gro_file
 
     if not os.path.isfile(mdp_file):
         logger.error("mdp file is not found!")
@@ -322,6 +423,17 @@ def get_mdrun_out_files(
     return (out_gro, out_energy)
 
 
+def get_work_dir(work_dir: str | None = None) -> str:
+    """
+    Helper that resolves (and creates) the directory a step writes its files
+    to. Flows that run concurrently need their own directory, since the steps
+    use fixed file names.
+    """
+    work_dir = os.path.abspath(work_dir or os.getcwd())
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+
 def get_mdp_path(file_name: str) -> str:
     """
     Helper that finds the full path to the mdp file specified by the input.
@@ -329,28 +441,84 @@ def get_mdp_path(file_name: str) -> str:
     return os.path.join(os.path.dirname(md_inputs.__file__), file_name)
 
 
+def read_mdp_parameters(mdp_file: str) -> dict[str, str]:
+    """
+    Helper that reads the parameter names and values out of an mdp file,
+    ignoring comments.
+    """
+    parameters = {}
+    with open(mdp_file, "r") as mdp:
+        for line in mdp:
+            line = line.split(";")[0]
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            parameters[key.strip()] = value.strip()
+    return parameters
+
+
+def write_mdp(mdp_file: str, parameters: dict[str, Any], out_file: str) -> str:
+    """
+    Helper that copies an mdp file, overriding (or appending) the given
+    parameters, and returns the path to the new mdp file.
+    """
+    remaining = {key: str(value) for key, value in parameters.items()}
+    lines = []
+    with open(mdp_file, "r") as mdp:
+        for line in mdp:
+            setting = line.split(";")[0]
+            key = setting.split("=")[0].strip()
+            if "=" in setting and key in remaining:
+                line = f"{key:<24}= {remaining.pop(key)}\n"
+            lines.append(line)
+    for key, value in remaining.items():
+        lines.append(f"{key:<24}= {value}\n")
+
+    with open(out_file, "w") as out:
+        out.writelines(lines)
+    return out_file
+
+
 def standard_md_run(
     md_input: MDRunInput,
     file_prefix: str = "run",
     nsteps: int | None = 10_000,
+    watchdog: WatchdogSettings | None = None,
+    threads: int | None = None,
+    work_dir: str | None = None,
 ) -> MDRun:
     """
     Runs a standard MD run given a tpr, and returns the md object along with
-    output gro and edr files.
+    output gro and edr files. The number of threads used by mdrun may be
+    capped, e.g. to share a worker with other runs. If a working directory is
+    given the output files are written to it, otherwise they are left in the
+    directory gmxapi runs mdrun in.
     """
+    if watchdog is not None:
+        return watched_md_run(
+            md_input, file_prefix, nsteps, watchdog, threads, work_dir
+        )
 
     tpr_input = gmxapi.read_tpr(md_input.tpr_file)
     if nsteps:
         tpr_input = gmxapi.modify_input(tpr_input, parameters={"nsteps": nsteps})
     logger.info(f"tpr input = {tpr_input}")
+    if work_dir is not None:
+        # gmxapi runs mdrun in a directory of its own, so point the outputs
+        # at the working directory by their absolute paths
+        file_prefix = os.path.join(get_work_dir(work_dir), file_prefix)
     gro_output = file_prefix + ".gro"
     edr_output = file_prefix + ".edr"
     traj_output = file_prefix + ".trr"
+    log_output = file_prefix + ".log"
     rargs = {
         "-o": traj_output,
         "-e": edr_output,
         "-c": gro_output,
+        "-g": log_output,
     }
+    if threads:
+        rargs["-nt"] = str(threads)
     md = gmxapi.mdrun(input=tpr_input, runtime_args=rargs)
     md.run()
 
@@ -365,7 +533,139 @@ def standard_md_run(
         gro_file=gro_path,
         energy=edr_path,
         md_object=md,
-        trajectory=md.output.trajectory.result(),
+        trajectory=os.path.join(md.output.directory.result(), traj_output),
+        log_file=os.path.join(md.output.directory.result(), log_output),
+        threads=threads,
     )
 
     return output
+
+
+def watched_md_run(
+    md_input: MDRunInput,
+    file_prefix: str,
+    nsteps: int | None,
+    settings: WatchdogSettings,
+    threads: int | None = None,
+    work_dir: str | None = None,
+) -> MDRun:
+    """
+    Runs an MD run under the instability watchdog. Whenever the run diverges
+    it is aborted, and retried from the same starting configuration with the
+    next fallback in the settings. Every aborted attempt is recorded as an
+    incident on the returned MDRun.
+    """
+    cwd = get_work_dir(work_dir)
+    # concurrent runs of the same stage share the working directory
+    run_id = uuid.uuid4().hex[:8]
+    incidents = []
+    fallbacks: list[Fallback | None] = [None, *settings.fallbacks]
+    for attempt, fallback in enumerate(fallbacks):
+        attempt_name = f"{file_prefix}_{run_id}_{attempt}"
+        attempt_input = md_input
+        attempt_nsteps = nsteps
+        if fallback is not None:
+            logger.info(f"retrying {file_prefix} with fallback {fallback.name}")
+            attempt_input = apply_fallback(
+                md_input, fallback, attempt_name, cwd, threads
+            )
+            if nsteps:
+                attempt_nsteps = round(nsteps * fallback_step_scale(md_input, fallback))
+
+        attempt_dir = os.path.join(cwd, attempt_name)
+        process, incident = run_watched_mdrun(
+            os.path.abspath(attempt_input.tpr_file),
+            work_dir=attempt_dir,
+            file_prefix=file_prefix,
+            settings=settings,
+            nsteps=attempt_nsteps,
+            attempt=attempt,
+            threads=threads,
+        )
+        if incident is None:
+            return MDRun(
+                md_input=attempt_input,
+                gro_file=os.path.join(attempt_dir, file_prefix + ".gro"),
+                energy=os.path.join(attempt_dir, file_prefix + ".edr"),
+                md_object=process,
+                trajectory=os.path.join(attempt_dir, file_prefix + ".trr"),
+                log_file=os.path.join(attempt_dir, file_prefix + ".log"),
+                threads=threads,
+                incidents=incidents,
+            )
+
+        incident.fallback = fallback.name if fallback else None
+        incidents.append(incident)
+
+    raise MDInstabilityError(incidents)
+
+
+def apply_fallback(
+    md_input: MDRunInput,
+    fallback: Fallback,
+    file_prefix: str,
+    work_dir: str | None = None,
+    threads: int | None = None,
+) -> MDRunInput:
+    """
+    Helper that rebuilds the tpr of an MD run with the safer settings of a
+    fallback, optionally minimizing the starting configuration first. The
+    position restraints keep the original reference configuration (see
+    `fallback_parameters` for the mdp overrides).
+    """
+    file_prefix = os.path.join(get_work_dir(work_dir), file_prefix)
+    conf = ProteinInput(gro_file=md_input.gro_file, top_file=md_input.top_file)
+    if fallback.minimize:
+        em_input = md_grompp(
+            input=conf,
+            mdp_file=get_mdp_path("steep.mdp"),
+            tpr_file_name=file_prefix + "_em.tpr",
+        )
+        em_run = standard_md_run(
+            em_input, file_prefix=file_prefix + "_em", threads=threads
+        )
+        conf = ProteinInput(gro_file=em_run.gro_file, top_file=md_input.top_file)
+
+    mdp_file = write_mdp(
+        md_input.settings_file,
+        fallback_parameters(md_input, fallback),
+        f"{file_prefix}_{fallback.name}.mdp",
+    )
+    return md_grompp(
+        input=conf,
+        mdp_file=mdp_file,
+        tpr_file_name=file_prefix + ".tpr",
+        posres=md_input.itp_file is not None,
+        reference=md_input.itp_file,
+    )
+
+
+def fallback_parameters(md_input: MDRunInput, fallback: Fallback) -> dict[str, Any]:
+    """
+    Helper that builds the mdp overrides of a fallback. The number of steps is
+    scaled with the time step so the same time is simulated. A minimized
+    configuration has no velocities, so they are regenerated at the reference
+    temperature instead of continuing (e.g. NPT after NVT) from 0 K.
+    """
+    settings = read_mdp_parameters(md_input.settings_file)
+    parameters = {}
+    if fallback.minimize:
+        parameters.update(gen_vel="yes", gen_seed=-1, continuation="no")
+        if "ref_t" in settings:
+            parameters["gen_temp"] = settings["ref_t"].split()[0]
+    parameters.update(fallback.parameters)
+    if "nsteps" not in parameters:
+        nsteps = int(settings["nsteps"])
+        parameters["nsteps"] = round(nsteps * fallback_step_scale(md_input, fallback))
+    return parameters
+
+
+def fallback_step_scale(md_input: MDRunInput, fallback: Fallback) -> float:
+    """
+    Helper that finds how many more steps a fallback needs to simulate the
+    same time as the original settings (e.g. twice as many for half the dt).
+    """
+    if "dt" not in fallback.parameters:
+        return 1.0
+    dt = float(read_mdp_parameters(md_input.settings_file)["dt"])
+    return dt / float(fallback.parameters["dt"])
@@ -0,0 +1,233 @@
+import logging
+import math
+import os
+import re
+import subprocess
+import time
+from .models import Incident, WatchdogSettings
+
+
+logger = logging.getLogger(__file__)
+
+# gromacs prints energy terms in fixed width columns in the md log
+LOG_COLUMN_WIDTH = 15
+# only the warnings themselves; the log also cites the SETTLE paper for every
+# run with rigid water
+CONSTRAINT_WARNING = re.compile(r"LINCS WARNING|can not be settled")
+WARNING_STEP = re.compile(r"[Ss]tep\s+(\d+)")
+# fatal errors mdrun exits with when the system blew up, as opposed to e.g. a
+# missing file or a bad tpr
+INSTABILITY_ERROR = re.compile(
+    r"LINCS warnings|can not be settled|not finite|extremely high"
+    r"|moved more than|times the cut-off"
+)
+# lines of the mdrun output included in errors
+OUTPUT_TAIL_LINES = 20
+
+
+class MDInstabilityError(Exception):
+    """
+    Raised when an mdrun keeps blowing up after every fallback was tried.
+    """
+
+    def __init__(self, incidents: list[Incident]):
+        self.incidents = incidents
+        reasons = "; ".join(
+            f"attempt {incident.attempt}: {incident.reason}" for incident in incidents
+        )
+        super().__init__(f"mdrun was unstable on every attempt ({reasons})")
+
+
+class MDRunError(Exception):
+    """
+    Raised when an mdrun fails for a reason other than instability (e.g. a
+    missing file or invalid input), which no fallback can fix.
+    """
+
+    def __init__(self, stage: str, returncode: int, output: str):
+        self.stage = stage
+        self.returncode = returncode
+        self.output = output
+        super().__init__(f"{stage} mdrun exited with code {returncode}:\n{output}")
+
+
+class LogMonitor:
+    """
+    Incrementally reads an mdrun log file and reports the first sign of an
+    unstable simulation (constraint warnings, exploding energies or
+    temperatures).
+    """
+
+    def __init__(self, log_file: str, settings: WatchdogSettings):
+        self.log_file = log_file
+        self.settings = settings
+        self.step: int | None = None
+        self.constraint_warnings = 0
+        self._offset = 0
+        self._buffer = ""
+        self._expect_step = False
+        self._in_energies = False
+        self._energy_names: list[str] | None = None
+
+    def poll(self) -> str | None:
+        """
+        Reads whatever was appended to the log since the last poll and returns
+        a reason string if the run looks unstable, otherwise None.
+        """
+        if not os.path.isfile(self.log_file):
+            return None
+        with open(self.log_file, "r", errors="replace") as log:
+            log.seek(self._offset)
+            chunk = log.read()
+            self._offset = log.tell()
+
+        # only process complete lines, keep the rest for the next poll
+        *lines, self._buffer = (self._buffer + chunk).split("\n")
+        for line in lines:
+            reason = self._check_line(line)
+            if reason:
+                return reason
+        return None
+
+    def _check_line(self, line: str) -> str | None:
+        tokens = line.split()
+        if self._expect_step:
+            self._expect_step = False
+            if tokens and tokens[0].isdigit():
+                self.step = int(tokens[0])
+            return None
+        if tokens == ["Step", "Time"]:
+            self._expect_step = True
+            return None
+
+        if CONSTRAINT_WARNING.search(line):
+            self.constraint_warnings += 1
+            match = WARNING_STEP.search(line)
+            if match:
+                self.step = int(match.group(1))
+            if self.constraint_warnings > self.settings.max_constraint_warnings:
+                return f"{self.constraint_warnings} constraint warnings"
+            return None
+
+        if "Energies (kJ/mol)" in line:
+            self._in_energies = True
+            self._energy_names = None
+            return None
+        if not self._in_energies:
+            return None
+        if not line.strip():
+            self._in_energies = False
+            return None
+        if self._energy_names is None:
+            self._energy_names = split_log_columns(line)
+            return None
+
+        names, self._energy_names = self._energy_names, None
+        return self._check_energies(dict(zip(names, split_log_columns(line))))
+
+    def _check_energies(self, energies: dict[str, str]) -> str | None:
+        for name, value in energies.items():
+            try:
+                number = float(value)
+            except ValueError:
+                return f"{name} could not be read ({value})"
+            if not math.isfinite(number):
+                return f"{name} is not finite"
+            if name == "Temperature" and number > self.settings.max_temperature:
+                return f"temperature reached {number:.1f} K"
+            if name == "Potential" and number > self.settings.max_potential_energy:
+                return f"potential energy reached {number:.5e} kJ/mol"
+        return None
+
+
+def split_log_columns(line: str) -> list[str]:
+    """
+    Helper that splits a fixed width line of an energy block in an mdrun log.
+    """
+    columns = [
+        line[i : i + LOG_COLUMN_WIDTH].strip()
+        for i in range(0, len(line), LOG_COLUMN_WIDTH)
+    ]
+    return [column for column in columns if column]
+
+
+def run_watched_mdrun(
+    tpr_file: str,
+    work_dir: str,
+    file_prefix: str,
+    settings: WatchdogSettings,
+    nsteps: int | None = None,
+    attempt: int = 0,
+    threads: int | None = None,
+) -> tuple[subprocess.Popen, Incident | None]:
+    """
+    Runs gmx mdrun in a subprocess while tailing its log. The run is
+    terminated as soon as the log shows it is diverging, in which case an
+    incident describing the failure is returned alongside the process. If
+    mdrun fails without any sign of instability, an MDRunError is raised.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    args = ["gmx", "mdrun", "-s", tpr_file, "-deffnm", file_prefix]
+    if nsteps:
+        args += ["-nsteps", str(nsteps)]
+    if threads:
+        args += ["-nt", str(threads)]
+    monitor = LogMonitor(os.path.join(work_dir, file_prefix + ".log"), settings)
+    out_file = os.path.join(work_dir, file_prefix + ".out")
+
+    logger.info(f"starting watched mdrun: {' '.join(args)}")
+    with open(out_file, "w") as out:
+        process = subprocess.Popen(
+            args, cwd=work_dir, stdout=out, stderr=subprocess.STDOUT
+        )
+        reason = None
+        while reason is None and process.poll() is None:
+            time.sleep(settings.poll_interval)
+            reason = monitor.poll()
+
+        if reason is not None:
+            logger.warning(f"aborting {file_prefix} mdrun: {reason}")
+            stop_process(process)
+        else:
+            # pick up whatever was written between the last poll and the exit
+            reason = monitor.poll()
+
+    if reason is None and process.returncode != 0:
+        output = read_tail(out_file)
+        # fatal errors are wrapped over several lines
+        error = INSTABILITY_ERROR.search(" ".join(output.split()))
+        if error is None and not monitor.constraint_warnings:
+            raise MDRunError(file_prefix, process.returncode, output)
+        reason = f"mdrun exited with code {process.returncode}"
+        if error is not None:
+            reason += f" ({error.group(0)})"
+
+    if reason is None:
+        return process, None
+    incident = Incident(
+        stage=file_prefix, attempt=attempt, reason=reason, step=monitor.step
+    )
+    return process, incident
+
+
+def read_tail(file: str, lines: int = OUTPUT_TAIL_LINES) -> str:
+    """
+    Helper that reads the last lines of a (possibly missing) text file.
+    """
+    if not os.path.isfile(file):
+        return ""
+    with open(file, "r", errors="replace") as text:
+        return "".join(text.readlines()[-lines:])
+
+
+def stop_process(process: subprocess.Popen, timeout: float = 30.0):
+    """
+    Asks mdrun to stop (it checkpoints and exits on SIGTERM), and kills it if
+    it doesn't exit in time.
+    """
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
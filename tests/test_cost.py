@@ -0,0 +1,121 @@
+from md_flow.cost import (
+    DEFAULT_THROUGHPUT,
+    CostModel,
+    PerformanceHistory,
+    count_atoms,
+    read_ns_per_day,
+)
+from md_flow.models import MDRun, MDRunInput, PerformanceRecord
+import os
+import pytest
+import tempfile
+import threading
+
+
+GRO_FILE = os.path.join(os.path.dirname(__file__), "npt_eq.gro")
+
+LOG_TAIL = """\
+               Core t (s)   Wall t (s)        (%)
+       Time:      812.345      101.543      800.0
+                 (ns/day)    (hour/ns)
+Performance:       17.021        1.410
+"""
+
+
+@pytest.fixture
+def tmp_dir():
+    with tempfile.TemporaryDirectory() as dir:
+        yield dir
+
+
+def test_count_atoms():
+    assert count_atoms(GRO_FILE) == 25342
+
+
+def test_threads_for():
+    model = CostModel(max_threads=8)
+    assert model.threads_for(1_000) == 1
+    assert model.threads_for(25_342) == 4
+    assert model.threads_for(500_000) == 8
+
+
+def test_estimate_npt():
+    model = CostModel(max_threads=8)
+    nvt, npt, prod = model.estimate_npt(GRO_FILE)
+
+    assert nvt.stage == "md_temp_equilibrate"
+    assert nvt.nsteps == 10_000
+    assert prod.nsteps == 500_000
+    assert prod.simulated_ns == pytest.approx(1.0)
+    assert prod.ns_per_day == pytest.approx(DEFAULT_THROUGHPUT * 4 / 25342)
+    assert prod.hours == pytest.approx(24 / prod.ns_per_day)
+
+    # same threads as the 30k atom reference system
+    assert model.relative_cost([nvt, npt, prod]) == pytest.approx(25342 / 30000)
+
+
+def test_history(tmp_dir):
+    path = os.path.join(tmp_dir, "performance.json")
+    history = PerformanceHistory(path)
+    assert history.throughput("gpu") == DEFAULT_THROUGHPUT
+
+    history.add(PerformanceRecord("gpu", atoms=30_000, threads=8, ns_per_day=200.0))
+    history.add(PerformanceRecord("cpu", atoms=30_000, threads=8, ns_per_day=20.0))
+
+    # the measurements are persisted and kept per node type
+    reloaded = PerformanceHistory(path)
+    assert reloaded.throughput("gpu") == pytest.approx(750_000)
+    assert reloaded.throughput("cpu") == pytest.approx(75_000)
+
+
+def test_concurrent_history(tmp_dir):
+    path = os.path.join(tmp_dir, "performance.json")
+    history = PerformanceHistory(path)
+    record = PerformanceRecord("gpu", atoms=30_000, threads=8, ns_per_day=200.0)
+    threads = [
+        threading.Thread(target=lambda: [history.add(record) for _ in range(20)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(PerformanceHistory(path).records) == 80
+    assert os.listdir(tmp_dir) == ["performance.json"]
+
+
+def test_shared_history(tmp_dir):
+    path = os.path.join(tmp_dir, "performance.json")
+    first, second = PerformanceHistory(path), PerformanceHistory(path)
+    first.add(PerformanceRecord("gpu", atoms=30_000, threads=8, ns_per_day=200.0))
+    second.add(PerformanceRecord("cpu", atoms=30_000, threads=8, ns_per_day=20.0))
+
+    # neither cluster loses the other's records
+    assert [record.node_type for record in PerformanceHistory(path).records] == [
+        "gpu",
+        "cpu",
+    ]
+    assert second.throughput("gpu") == pytest.approx(750_000)
+
+
+def test_record(tmp_dir):
+    log_file = os.path.join(tmp_dir, "prod.log")
+    with open(log_file, "w") as log:
+        log.write(LOG_TAIL)
+    assert read_ns_per_day(log_file) == pytest.approx(17.021)
+
+    model = CostModel(node_type="cpu", max_threads=8)
+    run = MDRun(
+        md_input=MDRunInput(tpr_file="prod.tpr", gro_file=GRO_FILE, top_file="topol.top"),
+        gro_file=GRO_FILE,
+        md_object=None,
+        energy="prod.edr",
+        trajectory="prod.trr",
+        log_file=log_file,
+        threads=4,
+    )
+    model.record(run)
+    assert model.history.records == [
+        PerformanceRecord("cpu", atoms=25342, threads=4, ns_per_day=17.021)
+    ]
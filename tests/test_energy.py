@@ -0,0 +1,163 @@
+from dask.core import get_dependencies
+from md_flow.energy import EDRFormatError, EnergyStore, read_edr
+from md_flow.flow import equilibrate_and_run_flow
+from md_flow.scheduling import stage_name
+from md_flow.steps import store_energies
+from md_flow.models import MDRun, MDRunInput
+import numpy as np
+import os
+import pytest
+import struct
+import tempfile
+
+
+def xdr_string(value: str) -> bytes:
+    data = value.encode() + b"\x00"
+    return struct.pack(">i", len(data)) + data.ljust((len(data) + 3) // 4 * 4, b"\x00")
+
+
+def write_edr(path: str, names: list[str], time: np.ndarray, values: np.ndarray):
+    """
+    Writes a minimal single precision (version 5) energy file like mdrun does,
+    with the averages of every term stored in the first frame only.
+    """
+    data = struct.pack(">iii", -55555, 5, len(names))
+    for name in names:
+        data += xdr_string(name) + xdr_string("kJ/mol")
+
+    for frame, (t, row) in enumerate(zip(time, values)):
+        nsum = 1 if frame == 0 else 0
+        data += struct.pack(">fiid", -2e10, -7777777, 5, t)
+        data += struct.pack(">qiqd", 500 * frame, nsum, 500, 1.0)
+        data += struct.pack(">iii", len(names), 0, 1)
+        # one block with an int sub-block
+        data += struct.pack(">iiii", 7, 1, 0, 2)
+        data += struct.pack(">iii", 0, 0, 0)
+        for value in row:
+            energy = [value, value, 0.0] if nsum else [value]
+            data += struct.pack(f">{len(energy)}f", *energy)
+        data += struct.pack(">ii", 3, 4)
+
+    with open(path, "wb") as edr:
+        edr.write(data)
+
+
+@pytest.fixture
+def tmp_dir():
+    with tempfile.TemporaryDirectory() as dir:
+        yield dir
+
+
+def make_run(dir: str, name: str, names: list[str], values: np.ndarray) -> MDRun:
+    edr_file = os.path.join(dir, name + ".edr")
+    write_edr(edr_file, names, np.arange(len(values)) * 1.0, values)
+    return MDRun(
+        md_input=MDRunInput(tpr_file=name + ".tpr", gro_file="conf.gro", top_file="topol.top"),
+        gro_file=name + ".gro",
+        md_object=None,
+        energy=edr_file,
+        trajectory=name + ".trr",
+    )
+
+
+def test_read_edr(tmp_dir):
+    path = os.path.join(tmp_dir, "npt_eq.edr")
+    values = np.array([[-7.8e5, 300.0], [-7.9e5, 301.5], [-7.85e5, 299.0]])
+    write_edr(path, ["Potential", "Temperature"], np.array([0.0, 1.0, 2.0]), values)
+
+    energies = read_edr(path)
+    assert energies.names == ["Potential", "Temperature"]
+    assert energies.units == ["kJ/mol", "kJ/mol"]
+    assert np.allclose(energies.time, [0.0, 1.0, 2.0])
+    assert list(energies.step) == [0, 500, 1000]
+    assert np.allclose(energies["Temperature"], values[:, 1])
+    assert np.allclose(energies.values, values, rtol=1e-6)
+
+
+def test_read_not_edr(tmp_dir):
+    path = os.path.join(tmp_dir, "npt_eq.edr")
+    with open(path, "wb") as edr:
+        edr.write(struct.pack(">iii", 1, 2, 3))
+    with pytest.raises(EDRFormatError):
+        read_edr(path)
+
+
+def test_energy_store(tmp_dir):
+    store = EnergyStore(os.path.join(tmp_dir, "energies"))
+    frames = np.arange(10.0)
+    stable = np.stack([np.full(10, 1000.0), np.full(10, -7.8e5)], axis=1)
+    drifting = np.stack([1000.0 - 2.0 * frames, np.full(10, -7.8e5)], axis=1)
+    nvt = np.stack([np.full(10, 300.0)], axis=1)
+
+    names = ["Density", "Potential"]
+    store.append(make_run(tmp_dir, "p1", names, stable), "P00250", "npt_eq")
+    store.append(make_run(tmp_dir, "p2", names, drifting), "P69905", "npt_eq")
+    store.append(make_run(tmp_dir, "p3", names, drifting), "P69905", "npt_eq", replica=1)
+    store.append(make_run(tmp_dir, "p4", ["Temperature"], nvt), "P00250", "nvt_eq")
+
+    # appending a run again replaces it
+    store.append(make_run(tmp_dir, "p1", names, stable), "P00250", "npt_eq")
+
+    table = store.read(["Density"], stage="npt_eq", proteins=["P69905"])
+    assert table.column_names == ["protein", "stage", "replica", "time", "Density"]
+    assert table.num_rows == 20
+
+    # terms a stage doesn't have are null
+    everything = store.read(["Temperature"])
+    assert everything.num_rows == 40
+    assert everything["Temperature"].null_count == 30
+
+    summary = store.summary("Density", stage="npt_eq").sort_by(
+        [("protein", "ascending"), ("replica", "ascending")]
+    )
+    assert summary["protein"].to_pylist() == ["P00250", "P69905", "P69905"]
+    assert summary["replica"].to_pylist() == [0, 0, 1]
+    assert summary["Density_drift"].to_pylist() == pytest.approx([0.0, -2.0, -2.0])
+    assert summary["Density_mean"].to_pylist() == pytest.approx([1000.0, 991.0, 991.0])
+
+
+def test_empty_energy_store(tmp_dir):
+    store = EnergyStore(os.path.join(tmp_dir, "energies"))
+    table = store.read(["Density"], stage="npt_eq")
+    assert table.column_names == ["protein", "stage", "replica", "time", "Density"]
+    assert table.num_rows == 0
+    assert store.summary("Density").num_rows == 0
+
+    # a stage nothing has been stored for yet
+    nvt = make_run(tmp_dir, "p1", ["Temperature"], np.full((3, 1), 300.0))
+    store.append(nvt, "P00250", "nvt_eq")
+    assert store.read(["Density"], stage="npt_eq").num_rows == 0
+    assert store.summary("Density", stage="nvt_eq").num_rows == 0
+    assert store.read(["Temperature"], stage="nvt_eq").num_rows == 3
+
+
+def test_store_tasks_reserve_no_cores():
+    flow = equilibrate_and_run_flow(None, threads=4, energy_store="energies", protein="P00250")
+    annotations = {
+        name.split("-")[0]: layer.annotations for name, layer in flow.dask.layers.items()
+    }
+    assert annotations["md_run"] == {"resources": {"cores": 4}}
+    assert annotations["store_energies"] is None
+
+
+def test_store_tasks_are_side_branches():
+    flow = equilibrate_and_run_flow(None, threads=4, energy_store="energies", protein="P00250")
+    graph = dict(flow.__dask_graph__())
+    dependencies = {
+        stage_name(key): {stage_name(dep) for dep in get_dependencies(graph, key)}
+        for key in graph
+        if stage_name(key) != "store_energies"
+    }
+    assert dependencies["md_pressure_equilibrate"] == {"md_temp_equilibrate"}
+    assert dependencies["md_run"] == {"md_pressure_equilibrate"}
+    assert dependencies["collect_run"] == {"md_run", "store_energies"}
+
+
+def test_failed_store(tmp_dir):
+    run = make_run(tmp_dir, "p1", ["Temperature"], np.full((3, 1), 300.0))
+    with open(run.energy, "wb") as edr:
+        edr.write(struct.pack(">iii", 1, 2, 3))
+
+    # a broken energy file doesn't fail the flow
+    stored = store_energies(run, os.path.join(tmp_dir, "energies"), "P00250", "nvt_eq")
+    assert stored.compute(scheduler="sync") is None
@@ -0,0 +1,52 @@
+from dask import delayed
+from md_flow.scheduling import STAGE_BOOSTS, prioritize, task_priorities
+import pytest
+
+
+def step(*upstream):
+    return len(upstream)
+
+
+def chain(protein: str):
+    stages = ["pdb2gmx", "md_temp_equilibrate", "md_run"]
+    flow = None
+    for stage in stages:
+        upstream = [] if flow is None else [flow]
+        flow = delayed(step)(*upstream, dask_key_name=f"{stage}-{protein}")
+    return flow
+
+
+def test_critical_path_priorities():
+    flow = chain("small")
+    costs = {"pdb2gmx": 1.0, "md_temp_equilibrate": 2.0, "md_run": 10.0}
+    priorities = task_priorities(dict(flow.dask), stage_costs=costs, stage_boosts={})
+
+    assert priorities["md_run-small"] == pytest.approx(10.0)
+    assert priorities["md_temp_equilibrate-small"] == pytest.approx(12.0)
+    assert priorities["pdb2gmx-small"] == pytest.approx(13.0)
+
+    # a larger system has a longer critical path at every stage
+    large = task_priorities(
+        dict(chain("large").dask), scale=4.0, stage_costs=costs, stage_boosts={}
+    )
+    assert large["md_run-large"] > priorities["pdb2gmx-small"]
+
+
+def test_prep_is_promoted():
+    priorities = task_priorities(dict(chain("small").dask))
+    large = task_priorities(dict(chain("large").dask), scale=5.0)
+
+    # preparing a small protein still goes ahead of a long production run
+    assert priorities["pdb2gmx-small"] > large["md_run-large"]
+    assert priorities["pdb2gmx-small"] > priorities["md_temp_equilibrate-small"]
+    assert priorities["md_run-small"] == pytest.approx(100.0)
+    assert "md_run" not in STAGE_BOOSTS
+
+
+def test_prioritize_keeps_flow():
+    flow = chain("small")
+    prioritized = prioritize(flow)
+
+    assert prioritized.key == flow.key
+    assert set(prioritized.dask) == set(flow.dask)
+    assert prioritized.compute() == 1
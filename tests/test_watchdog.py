@@ -0,0 +1,216 @@
+from md_flow.models import Fallback, MDRunInput, WatchdogSettings
+from md_flow.steps import (
+    fallback_parameters,
+    fallback_step_scale,
+    get_mdp_path,
+    read_mdp_parameters,
+    write_mdp,
+)
+from md_flow.watchdog import LogMonitor, MDRunError, run_watched_mdrun
+import os
+import pytest
+import stat
+import tempfile
+
+
+STABLE_BLOCK = """\
+           Step           Time
+            500        1.00000
+
+   Energies (kJ/mol)
+          Angle    Proper Dih.          LJ-14     Coulomb-14        LJ (SR)
+    9.74139e+03    1.26357e+04    4.32048e+03    5.05296e+04    9.48372e+04
+   Coulomb (SR)   Coul. recip.      Potential    Kinetic En.    Temperature
+   -9.59374e+05    4.09637e+03   -7.85644e+05    1.41025e+05    3.00312e+02
+
+"""
+
+HOT_BLOCK = """\
+           Step           Time
+           1000        2.00000
+
+   Energies (kJ/mol)
+          Angle    Proper Dih.          LJ-14     Coulomb-14        LJ (SR)
+    9.74139e+03    1.26357e+04    4.32048e+03    5.05296e+04    9.48372e+04
+   Coulomb (SR)   Coul. recip.      Potential    Kinetic En.    Temperature
+   -9.59374e+05    4.09637e+03   -7.85644e+05    4.70000e+05    1.00083e+03
+
+"""
+
+SETTLE_CITATION = """\
+++++ PLEASE READ AND CITE THE FOLLOWING REFERENCE ++++
+S. Miyamoto and P. A. Kollman
+SETTLE: An Analytical Version of the SHAKE and RATTLE Algorithms for Rigid
+Water Models
+J. Comp. Chem. 13 (1992) pp. 952-962
+-------- -------- --- Thank You --- -------- --------
+"""
+
+LINCS_WARNING = """\
+Step 1210, time 2.42 (ps)  LINCS WARNING
+relative constraint deviation after LINCS:
+rms 0.011297, max 0.310431 (between atoms 1254 and 1255)
+"""
+
+
+@pytest.fixture
+def log_file():
+    with tempfile.TemporaryDirectory() as dir:
+        yield os.path.join(dir, "nvt_eq.log")
+
+
+def append(file, text):
+    with open(file, "a") as log:
+        log.write(text)
+
+
+def test_stable_log(log_file):
+    monitor = LogMonitor(log_file, WatchdogSettings())
+    assert monitor.poll() is None
+
+    append(log_file, STABLE_BLOCK)
+    assert monitor.poll() is None
+    assert monitor.step == 500
+
+
+def test_exploding_temperature(log_file):
+    monitor = LogMonitor(log_file, WatchdogSettings())
+    append(log_file, STABLE_BLOCK)
+    assert monitor.poll() is None
+
+    # the energy block may arrive over several polls
+    append(log_file, HOT_BLOCK[:200])
+    assert monitor.poll() is None
+    append(log_file, HOT_BLOCK[200:])
+    reason = monitor.poll()
+    assert "temperature" in reason
+    assert monitor.step == 1000
+
+
+def test_non_finite_energy(log_file):
+    monitor = LogMonitor(log_file, WatchdogSettings())
+    append(log_file, STABLE_BLOCK.replace("-7.85644e+05", "           nan"))
+    assert "Potential" in monitor.poll()
+
+
+def test_constraint_warnings(log_file):
+    monitor = LogMonitor(log_file, WatchdogSettings(max_constraint_warnings=2))
+    append(log_file, STABLE_BLOCK + LINCS_WARNING * 2)
+    assert monitor.poll() is None
+
+    append(log_file, LINCS_WARNING)
+    assert "constraint warnings" in monitor.poll()
+    assert monitor.step == 1210
+
+
+def test_settle_citation(log_file):
+    monitor = LogMonitor(log_file, WatchdogSettings(max_constraint_warnings=0))
+    append(log_file, SETTLE_CITATION + STABLE_BLOCK)
+    assert monitor.poll() is None
+    assert monitor.constraint_warnings == 0
+
+
+def test_fallback_step_scale():
+    md_input = MDRunInput(
+        tpr_file="nvt_eq.tpr",
+        gro_file="em.gro",
+        top_file="topol.top",
+        settings_file=get_mdp_path("nvt_eq.mdp"),
+    )
+    assert fallback_step_scale(md_input, Fallback("half_dt", {"dt": 0.001})) == 2.0
+    assert fallback_step_scale(md_input, Fallback("minimize", minimize=True)) == 1.0
+
+
+def test_write_mdp(log_file):
+    out_file = os.path.join(os.path.dirname(log_file), "nvt_eq_half_dt.mdp")
+    write_mdp(get_mdp_path("nvt_eq.mdp"), {"dt": 0.001, "nstcalcenergy": 50}, out_file)
+
+    original = read_mdp_parameters(get_mdp_path("nvt_eq.mdp"))
+    parameters = read_mdp_parameters(out_file)
+    assert parameters["dt"] == "0.001"
+    assert parameters["nstcalcenergy"] == "50"
+    assert parameters["nsteps"] == original["nsteps"]
+    assert len(parameters) == len(original) + 1
+
+
+def test_minimize_fallback_mdp(log_file):
+    md_input = MDRunInput(
+        tpr_file="npt_eq.tpr",
+        gro_file="nvt_eq.gro",
+        top_file="topol.top",
+        settings_file=get_mdp_path("npt_eq.mdp"),
+    )
+    fallback = Fallback("minimize_half_dt", {"dt": 0.001}, minimize=True)
+    out_file = os.path.join(os.path.dirname(log_file), "npt_eq_minimize_half_dt.mdp")
+    write_mdp(md_input.settings_file, fallback_parameters(md_input, fallback), out_file)
+
+    # the minimized configuration has no velocities to continue from
+    parameters = read_mdp_parameters(out_file)
+    assert parameters["gen_vel"] == "yes"
+    assert parameters["gen_temp"] == "300"
+    assert parameters["continuation"] == "no"
+    assert parameters["dt"] == "0.001"
+    assert parameters["nsteps"] == "100000"
+
+    # without minimizing the run continues from the previous stage
+    parameters = fallback_parameters(md_input, Fallback("half_dt", {"dt": 0.001}))
+    assert parameters == {"dt": 0.001, "nsteps": 100000}
+
+
+def fake_gmx(dir: str, output: str, returncode: int):
+    """
+    Puts a gmx executable on the path that prints the output and exits.
+    """
+    bin_dir = os.path.join(dir, "bin")
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, "gmx")
+    with open(path, "w") as gmx:
+        gmx.write(f"#!/bin/sh\ncat <<'EOF'\n{output}EOF\nexit {returncode}\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return bin_dir
+
+
+BAD_INPUT = """-------------------------------------------------------
+Program:     gmx mdrun, version 2023.3
+Source file: src/gromacs/utility/futil.cpp (line 534)
+
+File input/output error:
+nvt_eq.tpr
+-------------------------------------------------------
+"""
+
+TOO_MANY_WARNINGS = """-------------------------------------------------------
+Program:     gmx mdrun, version 2023.3
+Source file: src/gromacs/mdlib/constr.cpp (line 215)
+
+Fatal error:
+Too many LINCS warnings (1000)
+If you know what you are doing you can adjust the lincs warning threshold in
+your mdp file
+-------------------------------------------------------
+"""
+
+
+def test_bad_input(log_file, monkeypatch):
+    dir = os.path.dirname(log_file)
+    monkeypatch.setenv(
+        "PATH", fake_gmx(dir, BAD_INPUT, 1) + os.pathsep + os.environ["PATH"]
+    )
+
+    # no fallback can fix the input, so it isn't retried
+    with pytest.raises(MDRunError, match="nvt_eq.tpr"):
+        run_watched_mdrun(
+            "nvt_eq.tpr", dir, "nvt_eq", WatchdogSettings(poll_interval=0.01)
+        )
+
+
+def test_fatal_instability(log_file, monkeypatch):
+    dir = os.path.dirname(log_file)
+    monkeypatch.setenv(
+        "PATH", fake_gmx(dir, TOO_MANY_WARNINGS, 1) + os.pathsep + os.environ["PATH"]
+    )
+
+    _, incident = run_watched_mdrun(
+        "nvt_eq.tpr", dir, "nvt_eq", WatchdogSettings(poll_interval=0.01)
+    )
+    assert "LINCS warnings" in incident.reason